@@ -1,12 +1,60 @@
 use anyhow::{anyhow, Result};
 use log::{debug, error, info, warn};
 use serde_json::{self, json, Value};
-use std::process::{Command, Stdio};
-use std::io::{BufRead, BufReader, Write};
-use std::time::{Duration, Instant};
-use std::thread;
+use std::process::Stdio;
+use std::time::Duration;
+use tokio::io::{AsyncBufReadExt, AsyncWriteExt, BufReader};
+use tokio::process::{ChildStdout, Command};
+use tokio::time::{timeout_at, Instant};
 
-fn main() -> Result<()> {
+/// Upper bound for the initialize response; `npx -y` may have to download the package first.
+const INIT_TIMEOUT: Duration = Duration::from_secs(60);
+/// Upper bound for the tools/list response.
+const TOOLS_TIMEOUT: Duration = Duration::from_secs(10);
+
+/// Waits for the JSON-RPC response whose `id` matches `id`, skipping any other
+/// stdout lines (notifications, log noise). Fails once `timeout` has elapsed
+/// or the server closes stdout.
+///
+/// `buf` is owned by the caller so bytes of a partially read line survive a
+/// timeout; it is only cleared once a full line has been handled.
+async fn wait_for_response(
+    reader: &mut BufReader<ChildStdout>,
+    buf: &mut Vec<u8>,
+    id: &str,
+    timeout: Duration,
+) -> Result<Value> {
+    let deadline = Instant::now() + timeout;
+    loop {
+        // `read_until` is cancel-safe: bytes read before a timeout stay in `buf`
+        let n = timeout_at(deadline, reader.read_until(b'\n', buf))
+            .await
+            .map_err(|_| anyhow!("No response for '{}': timed out", id))??;
+        if n == 0 {
+            return Err(anyhow!("No response for '{}': stdout closed", id));
+        }
+        // Decode lossily so stray non-UTF-8 bytes are skipped as noise, like stderr
+        let line = String::from_utf8_lossy(&buf[..]);
+        let response = match serde_json::from_str::<Value>(&line) {
+            Ok(msg) if msg.get("id").and_then(Value::as_str) == Some(id) => Some(msg),
+            Ok(_) => {
+                debug!("Skipping unrelated message: {}", line.trim());
+                None
+            }
+            Err(e) => {
+                warn!("Non-JSON line on stdout ({}): {}", e, line.trim());
+                None
+            }
+        };
+        buf.clear();
+        if let Some(msg) = response {
+            return Ok(msg);
+        }
+    }
+}
+
+#[tokio::main]
+async fn main() -> Result<()> {
     // Initialize logger
     env_logger::Builder::new()
         .filter_level(log::LevelFilter::Debug)
@@ -22,6 +70,8 @@ fn main() -> Result<()> {
         .arg("--access-token")
         .arg("test_token") // Replace with actual token if needed
         .env("SUPABASE_ACCESS_TOKEN", "test_token")
+        // A handshake timeout returns early via `?`; make sure the server dies with us
+        .kill_on_drop(true)
         .stdin(Stdio::piped())
         .stdout(Stdio::piped())
         .stderr(Stdio::piped());
@@ -34,25 +84,29 @@ fn main() -> Result<()> {
     let stdout = process.stdout.take().expect("Failed to open stdout");
     let stderr = process.stderr.take().expect("Failed to open stderr");
     
-    // Create thread for reading stderr
-    thread::spawn(move || {
-        let reader = BufReader::new(stderr);
-        for line in reader.lines() {
-            match line {
-                Ok(line) => warn!("[STDERR] {}", line),
-                Err(e) => error!("Error reading stderr: {}", e),
+    // Log stderr from its own task, reusing one line buffer. Lines are
+    // decoded lossily, so invalid UTF-8 is logged with replacement characters.
+    tokio::spawn(async move {
+        let mut reader = BufReader::new(stderr);
+        let mut line = Vec::new();
+        loop {
+            line.clear();
+            match reader.read_until(b'\n', &mut line).await {
+                Ok(0) => break,
+                Ok(_) => warn!("[STDERR] {}", String::from_utf8_lossy(&line).trim_end()),
+                Err(e) => {
+                    error!("Error reading stderr: {}", e);
+                    break;
+                }
             }
         }
     });
     
-    // Create buffered reader for stdout
+    // stdout is read directly by the handshake below, which awaits each response by id
     let mut stdout_reader = BufReader::new(stdout);
+    let mut stdout_buf = Vec::new();
     let mut stdin_writer = stdin;
     
-    // Give process time to start up
-    info!("Waiting 1 second for server to start...");
-    thread::sleep(Duration::from_secs(1));
-    
     // Step 1: Send initialize request
     info!("Sending initialize request...");
     let init_request = json!({
@@ -74,22 +128,16 @@ fn main() -> Result<()> {
     });
     
     let init_str = serde_json::to_string(&init_request)? + "\n";
-    info!("Request: {}", init_request);
-    
-    stdin_writer.write_all(init_str.as_bytes())?;
-    stdin_writer.flush()?;
-    
-    // Read the response
-    let mut init_response = String::new();
-    stdout_reader.read_line(&mut init_response)?;
+    info!("Request: {}", init_str.trim_end());
     
-    info!("Initialize response: {}", init_response.trim());
+    stdin_writer.write_all(init_str.as_bytes()).await?;
+    stdin_writer.flush().await?;
     
-    // Parse the response
-    let init_json: Value = serde_json::from_str(&init_response)?;
+    // Wait for the matching response; the server answers as soon as it is up
+    let init_json = wait_for_response(&mut stdout_reader, &mut stdout_buf, "init-123", INIT_TIMEOUT).await?;
+    info!("Initialize response: {}", init_json);
     
-    // Step 2: Send initialized notification
-    info!("Sending initialized notification...");
+    // Step 2: Build initialized notification
     let notification = json!({
         "jsonrpc": "2.0",
         "method": "notifications/initialized",
@@ -97,16 +145,9 @@ fn main() -> Result<()> {
     });
     
     let notification_str = serde_json::to_string(&notification)? + "\n";
-    info!("Notification: {}", notification);
-    
-    stdin_writer.write_all(notification_str.as_bytes())?;
-    stdin_writer.flush()?;
-    
-    // Wait a bit for notification to be processed
-    thread::sleep(Duration::from_millis(500));
+    info!("Notification: {}", notification_str.trim_end());
     
-    // Step 3: Send tools/list request
-    info!("Sending tools/list request...");
+    // Step 3: Build tools/list request
     let tools_request = json!({
         "jsonrpc": "2.0",
         "method": "tools/list",
@@ -115,54 +156,42 @@ fn main() -> Result<()> {
     });
     
     let tools_str = serde_json::to_string(&tools_request)? + "\n";
-    info!("Request: {}", tools_request);
+    info!("Request: {}", tools_str.trim_end());
     
-    stdin_writer.write_all(tools_str.as_bytes())?;
-    stdin_writer.flush()?;
-    
-    // Read the response with a timeout
-    let start = Instant::now();
-    let timeout = Duration::from_secs(10);
+    // The notification and tools/list are independent messages, so submit
+    // them in a single write; the server reads them in order off the pipe.
+    info!("Sending initialized + tools/list...");
+    let batch = notification_str + &tools_str;
+    stdin_writer.write_all(batch.as_bytes()).await?;
+    stdin_writer.flush().await?;
     
     info!("Waiting for tools/list response...");
     
-    let mut tools_response = String::new();
-    
-    // Use read_line which is better for line-based protocols like JSON-RPC
-    match stdout_reader.read_line(&mut tools_response) {
-        Ok(n) => {
-            info!("Read {} bytes from stdout", n);
-            info!("Got tools/list response: {}", tools_response.trim());
+    match wait_for_response(&mut stdout_reader, &mut stdout_buf, "tools-123", TOOLS_TIMEOUT).await {
+        Ok(json) => {
+            info!("Got tools/list response: {}", json);
             
-            // Parse the tools list
-            match serde_json::from_str::<Value>(&tools_response) {
-                Ok(json) => {
-                    if let Some(result) = json.get("result") {
-                        if let Some(tools) = result.get("tools") {
-                            if let Some(tools_array) = tools.as_array() {
-                                info!("Found {} tools", tools_array.len());
-                                
-                                // Print details of each tool
-                                for (i, tool) in tools_array.iter().enumerate() {
-                                    info!("Tool {}: {}", i+1, tool.get("name").and_then(|n| n.as_str()).unwrap_or("unknown"));
-                                }
-                            }
+            if let Some(result) = json.get("result") {
+                if let Some(tools) = result.get("tools") {
+                    if let Some(tools_array) = tools.as_array() {
+                        info!("Found {} tools", tools_array.len());
+                        
+                        // Print details of each tool
+                        for (i, tool) in tools_array.iter().enumerate() {
+                            info!("Tool {}: {}", i+1, tool.get("name").and_then(|n| n.as_str()).unwrap_or("unknown"));
                         }
                     }
                 }
-                Err(e) => {
-                    error!("Failed to parse tools response: {}", e);
-                }
             }
         }
         Err(e) => {
-            error!("Error reading from stdout: {}", e);
+            error!("Failed to get tools/list response: {}", e);
         }
     }
     
     // Clean up
     info!("Test completed, killing process");
-    let _ = process.kill();
+    let _ = process.kill().await;
     
     Ok(())
 }